@@ -31,17 +31,29 @@ To resume the training from converted MegatronLM checkpoint, make sure to set th
 `trainer.max_steps=round(lr-warmup-fraction * lr-decay-iters + lr-decay-iters)`
 where  `lr-warmup-fraction` and `lr-decay-iters` are arguments from MegatronLM training
 so the learning rate scheduler will follow the same curve.
+The Megatron_LM checkpoint is memory mapped rather than read into memory, and the converted weights and
+optimizer states are views into that mapping. Do not delete or overwrite the input checkpoint until the
+conversion script has finished writing its outputs.
 """
 
+import copy
+import gc
 import importlib
+import inspect
+import itertools
+import mmap
 import os
 import pathlib
+import re
 import sys
 from argparse import ArgumentParser
-from collections import OrderedDict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Optional
 
+import einops
 import torch
+import torch.distributed.checkpoint as dcp
 from lightning_fabric.utilities.cloud_io import _load as pl_load
 from megatron.core import parallel_state
 from pytorch_lightning.core.saving import _load_state as ptl_load_state
@@ -57,30 +69,6 @@ from nemo.utils import AppState, logging
 from nemo.utils.distributed import initialize_distributed
 from nemo.utils.model_utils import inject_model_parallel_rank, uninject_model_parallel_rank
 
-# this enums code is copied from Megatron_LM
-enum_code = '''
-import enum
-
-class ModelType(enum.Enum):
-    encoder_or_decoder = 1
-    encoder_and_decoder = 2
-
-
-class LayerType(enum.Enum):
-    encoder = 1
-    decoder = 2
-
-
-class AttnType(enum.Enum):
-    self_attn = 1
-    cross_attn = 2
-
-
-class AttnMaskType(enum.Enum):
-    padding = 1
-    causal = 2
-'''
-
 
 def install_megatron_dependence():
     # this is a hack to install required modules for MegatronLM checkpoints
@@ -101,15 +89,17 @@ def install_megatron_dependence():
     sys.modules[megatron_name + '.' + model_name] = model_module
 
     enums_name = 'enums'
-    enums_spec = importlib.util.spec_from_loader(enums_name, loader=None, is_package=True)
+    # loaded by path under its Megatron-LM name, so it doesn't depend on sys.path and pickles like the original module
+    enums_spec = importlib.util.spec_from_file_location(
+        megatron_name + '.' + model_name + '.' + enums_name, pathlib.Path(__file__).with_name('megatron_lm_stubs.py')
+    )
     enums_module = importlib.util.module_from_spec(enums_spec)
+    enums_spec.loader.exec_module(enums_module)
 
-    model_module.__dict__['enums'] = enums_module
+    model_module.__dict__[enums_name] = enums_module
 
     sys.modules[megatron_name + '.' + model_name + '.' + enums_name] = enums_module
 
-    exec(enum_code, enums_module.__dict__)
-
 
 def get_args():
     parser = ArgumentParser()
@@ -138,7 +128,11 @@ def get_args():
     parser.add_argument("--nemo_file_path", type=str, default=None, required=False, help="Path to output .nemo file.")
 
     parser.add_argument(
-        "--output_ckpt_file_path", type=str, default=None, required=False, help="Path to output .ckpt file."
+        "--output_ckpt_file_path",
+        type=str,
+        default=None,
+        required=False,
+        help="Path to output .ckpt file. If it is an existing directory, a torch.distributed.checkpoint is saved there instead.",
     )
 
     parser.add_argument("--gpus_per_node", type=int, required=False, default=1)
@@ -150,25 +144,43 @@ def get_args():
 
     parser.add_argument("--model_type", type=str, required=True, default="gpt", choices=["gpt", "t5", "bert"])
 
+    parser.add_argument(
+        "--use_direct_io",
+        action="store_true",
+        help="Read the Megatron-LM checkpoint with O_DIRECT (Linux only), bypassing the page cache. Speeds up loading from a cold page cache, but the whole file is read into memory and the tensors are copied out of it, so peak memory is about twice the checkpoint size, unlike the default memory mapped load.",
+    )
+
     args = parser.parse_args()
     return args
 
 
-def parse_weights(weight_dict: OrderedDict, parent_key: str, total: list, converted: OrderedDict, translator: dict):
-    for key in weight_dict:
-        new_key = key
-        name_translate = translator
+def compile_translator(translator: dict):
+    # longest patterns first so that a short pattern never shadows a longer one it is part of
+    return re.compile('|'.join(map(re.escape, sorted(translator, key=len, reverse=True))))
+
+
+def parse_weights(weight_dict: dict, parent_key: str, pattern: re.Pattern, translator: dict):
+    """
+    Walks the nested Megatron-LM weight dict and yields (nemo_key, tensor) pairs in the original order.
+    Entries are popped from `weight_dict` as they are yielded, so it is left empty once the walk is done.
+    """
 
-        for replace_key in name_translate:
-            if key.find(replace_key) >= 0:
-                new_key = key.replace(replace_key, name_translate[replace_key])
-        if isinstance(weight_dict[key], OrderedDict) or isinstance(weight_dict[key], dict):
-            parse_weights(weight_dict[key], parent_key + '.' + new_key, total, converted, translator)
+    def translate(match):
+        return translator[match.group(0)]
+
+    stack = deque([(parent_key, weight_dict, iter(list(weight_dict)))])
+    while stack:
+        prefix, source, keys = stack[-1]
+        for key in keys:
+            # the source dict drops its reference as soon as the tensor is handed over
+            value = source.pop(key)
+            new_key = pattern.sub(translate, key)
+            if isinstance(value, dict):
+                stack.append((prefix + '.' + new_key, value, iter(list(value))))
+                break
+            yield 'model' + prefix + '.' + new_key, value
         else:
-            num_parameters = torch.prod(torch.tensor(weight_dict[key].cpu().size())).item()
-            total[0] += num_parameters
-            final_key = 'model' + parent_key + '.' + new_key
-            converted[final_key] = weight_dict[key]
+            stack.pop()
 
 
 def add_optimizer_state(lm_checkpoint, new_checkpoint, megatron_amp_o2=True):
@@ -202,33 +214,96 @@ def add_optimizer_state(lm_checkpoint, new_checkpoint, megatron_amp_o2=True):
     if LR_SCHEDULER in lm_checkpoint:
         gbs = lm_checkpoint['args'].global_batch_size
         sched = lm_checkpoint[LR_SCHEDULER]
-        content = OrderedDict()
-        content['max_steps'] = int(sched['decay_steps']) // gbs + sched['warmup_steps'] // gbs
-        content['warmup_steps'] = int(sched['warmup_steps']) // gbs
+        decay_steps = int(sched['decay_steps']) // gbs
+        warmup_steps = int(sched['warmup_steps']) // gbs
+        num_steps = int(sched['num_steps']) // gbs
+        content = {}
+        content['max_steps'] = decay_steps + warmup_steps
+        content['warmup_steps'] = warmup_steps
         content['constant_steps'] = 0  # no such conf in lm checkpoint
-        content['decay_steps'] = int(sched['decay_steps']) // gbs
+        content['decay_steps'] = decay_steps
         content['min_lr'] = sched['min_lr']
         if OPTIMIZER_KEY in lm_checkpoint:
-            content['base_lrs'] = [
-                i['initial_lr'] for i in new_checkpoint['optimizer_states'][0]['optimizer']['param_groups']
-            ]
-            content['last_epoch'] = int(sched['num_steps']) // gbs
-            content['_last_lr'] = [i['lr'] for i in new_checkpoint['optimizer_states'][0]['optimizer']['param_groups']]
+            base_lrs = []
+            last_lrs = []
+            for param_group in new_checkpoint['optimizer_states'][0]['optimizer']['param_groups']:
+                base_lrs.append(param_group['initial_lr'])
+                last_lrs.append(param_group['lr'])
+            content['base_lrs'] = base_lrs
+            content['last_epoch'] = num_steps
+            content['_last_lr'] = last_lrs
         else:
             content['base_lrs'] = [sched['max_lr']]
-            content['last_epoch'] = int(sched['num_steps']) // gbs
-        content['_step_count'] = int(sched['num_steps']) // gbs
+            content['last_epoch'] = num_steps
+        content['_step_count'] = num_steps
         content['verbose'] = False
         content['_get_lr_called_within_step'] = False
         new_checkpoint[NEW_LR_SCHEDULER] = [content]
 
 
+def load_state_on_meta_device(cls, checkpoint, strict, **kwargs):
+    """
+    Builds the model on the meta device and adopts the checkpoint tensors as its weights with
+    `load_state_dict(assign=True)`, so the weights are never allocated a second time.
+    Layers that allocate their weights on an explicit device ignore the meta device, a model built entirely that way
+    is loaded by copying the checkpoint tensors into it instead.
+    Returns None when the model can't be loaded this way and has to go through `ptl_load_state` instead.
+    """
+    if 'assign' not in inspect.signature(torch.nn.Module.load_state_dict).parameters:
+        # torch<2.1
+        return None
+    try:
+        with torch.device('meta'):
+            model = cls(**kwargs)
+    except (NotImplementedError, RuntimeError) as e:
+        # model setups that read tensor values or copy them between devices can't be built on the meta device
+        if 'meta' not in str(e):
+            raise
+        logging.warning(f"Could not build {cls.__name__} on the meta device, falling back to a regular load: {e}")
+        return None
+
+    tensors = list(itertools.chain(model.parameters(), model.buffers()))
+    on_meta = [tensor.is_meta for tensor in tensors]
+    if any(on_meta) and not all(on_meta):
+        # assigning CPU checkpoint tensors next to weights already allocated elsewhere would mix devices
+        logging.warning(f"{cls.__name__} was only partially built on the meta device, falling back to a regular load")
+        return None
+
+    # the hook may consume the state dict, keep the original intact for the fallback path
+    checkpoint = dict(checkpoint, state_dict=dict(checkpoint['state_dict']))
+    model.on_load_checkpoint(checkpoint)
+    state_dict = checkpoint['state_dict']
+    if all(on_meta):
+        # assigning adopts the checkpoint tensors as they are, cast them to the dtypes the model declared, e.g. fp32
+        # params for an fp16 Megatron-LM checkpoint, as copying them into the model would
+        declared = model.state_dict()
+        state_dict = {
+            key: tensor.to(declared[key].dtype) if key in declared and tensor.dtype != declared[key].dtype else tensor
+            for key, tensor in state_dict.items()
+        }
+    model.load_state_dict(state_dict, strict=strict, assign=all(on_meta))
+    if any(tensor.is_meta for tensor in itertools.chain(model.parameters(), model.buffers())):
+        # weights or buffers that don't come from the checkpoint would be left unallocated
+        logging.warning(
+            f"{cls.__name__} has weights or buffers missing from the checkpoint, falling back to a regular load"
+        )
+        return None
+    return model
+
+
+def load_state(cls, checkpoint, strict, **kwargs):
+    model = load_state_on_meta_device(cls, checkpoint, strict, **kwargs)
+    if model is None:
+        model = ptl_load_state(cls, checkpoint, strict=strict, **kwargs)
+    return model
+
+
 def load_model(cls, checkpoint, strict, **kwargs):
     try:
         if 'cfg' in kwargs:
-            model = ptl_load_state(cls, checkpoint, strict=strict, **kwargs)
+            model = load_state(cls, checkpoint, strict=strict, **kwargs)
         else:
-            model = ptl_load_state(
+            model = load_state(
                 cls, checkpoint, strict=strict, cfg=checkpoint[cls.CHECKPOINT_HYPER_PARAMS_KEY].cfg, **kwargs
             )
             # register the artifacts
@@ -244,36 +319,107 @@ def load_model(cls, checkpoint, strict, **kwargs):
     return model
 
 
+def fault_in(tensor: torch.Tensor):
+    # reading one element per page is enough to make the kernel page in a memory mapped storage
+    if tensor.numel() > 0 and tensor.is_contiguous():
+        step = max(1, mmap.PAGESIZE // tensor.element_size())
+        tensor.view(-1)[::step].sum()
+
+
+def read_file_direct(filepath: str) -> mmap.mmap:
+    """
+    Reads the whole file with O_DIRECT into memory, bypassing the page cache. This is faster than going through
+    the page cache for a large checkpoint on a cold start, e.g. right after a node was rebooted.
+    Returns the anonymous memory mapping the file was read into, which is file-like, so it can be loaded from
+    without copying it.
+    """
+    size = os.path.getsize(filepath)
+    chunk_size = 16 * 1024 * 1024 if size > 10 * 1024 ** 3 else 64 * 1024
+    # anonymous mmap memory is page aligned, which satisfies the O_DIRECT buffer alignment,
+    # and is rounded up to whole chunks so that every read is a multiple of the block size
+    buffer = mmap.mmap(-1, -(-size // chunk_size) * chunk_size)
+    view = memoryview(buffer)
+    fd = os.open(filepath, os.O_RDONLY | os.O_DIRECT)
+    try:
+        offset = 0
+        while offset < size:
+            num_bytes = os.preadv(fd, [view[offset : offset + chunk_size]], offset)
+            if num_bytes == 0:
+                break
+            offset += num_bytes
+    finally:
+        os.close(fd)
+    # trim the padding of the last chunk, which requires releasing the buffer exported to the reads
+    view.release()
+    buffer.resize(size)
+    return buffer
+
+
 def load_from_checkpoint(
     cls,
     checkpoint_path: str,
     map_location: Any = None,
     hparams_file: Optional[str] = None,
     strict: bool = True,
+    direct_io: bool = False,
     **kwargs,
 ):
     """
         Loads Megatron_LM checkpoints, convert it, with some maintenance of restoration.
         For documentation, please refer to LightningModule.load_from_checkpoin() documentation.
+        The returned tensors may be backed by a memory mapping of `checkpoint_path`, so the file must stay in
+        place until the converted checkpoint has been saved.
         """
     checkpoint = None
     try:
         cls._set_model_restore_state(is_being_restored=True)
         # TODO: replace with proper PTL API
 
-        with pl_legacy_patch():
-            if map_location is not None:
-                old_checkpoint = pl_load(checkpoint_path, map_location=map_location)
+        if map_location is None:
+            map_location = 'cpu'
+        old_checkpoint = None
+        if direct_io:
+            try:
+                checkpoint_buffer = read_file_direct(checkpoint_path)
+            except (AttributeError, OSError) as e:
+                # O_DIRECT is Linux only and not every file system supports it
+                logging.warning(f"direct I/O read of {checkpoint_path} failed, falling back to a regular load: {e}")
             else:
-                old_checkpoint = pl_load(checkpoint_path, map_location=lambda storage, loc: storage)
-
-        total_params = [0]
-        checkpoint = OrderedDict()
-        checkpoint['state_dict'] = OrderedDict()
-        parse_weights(
-            old_checkpoint['model'], "", total_params, checkpoint['state_dict'], translator=kwargs['translator']
-        )
-        print('converted {:.2f}M parameters'.format(total_params[0] / 1e6))
+                try:
+                    with pl_legacy_patch():
+                        old_checkpoint = torch.load(checkpoint_buffer, map_location=map_location, weights_only=False)
+                finally:
+                    checkpoint_buffer.close()
+
+        mmapped = False
+        if old_checkpoint is None:
+            with pl_legacy_patch():
+                try:
+                    # map the tensor storages lazily from the file instead of reading the whole checkpoint into memory
+                    # optimizer states and args hold non-tensor objects, so `weights_only` has to stay off
+                    old_checkpoint = torch.load(
+                        checkpoint_path, map_location=map_location, mmap=True, weights_only=False
+                    )
+                    mmapped = True
+                except (TypeError, RuntimeError):
+                    # `mmap` requires torch>=2.1 and a checkpoint saved with the zipfile serialization
+                    old_checkpoint = pl_load(checkpoint_path, map_location=map_location)
+
+        checkpoint = {}
+        checkpoint['state_dict'] = {}
+        # page the memory mapped weights in from background threads while the keys are being translated
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            for key, weight in parse_weights(
+                old_checkpoint['model'],
+                "",
+                pattern=compile_translator(kwargs['translator']),
+                translator=kwargs['translator'],
+            ):
+                if mmapped:
+                    executor.submit(fault_in, weight)
+                checkpoint['state_dict'][key] = weight
+        total_params = sum(weight.numel() for weight in checkpoint['state_dict'].values())
+        print('converted {:.2f}M parameters'.format(total_params / 1e6))
 
         if hparams_file is not None:
             extension = hparams_file.split(".")[-1]
@@ -301,36 +447,20 @@ def load_from_checkpoint(
                 logging.warning("cannot determine the number attention heads")
                 raise ValueError('need to know number of attention heads')
 
+            qkv_keys = [key for key in checkpoint['state_dict'] if 'query_key_value' in key]
+            # the trailing ellipsis covers both the weights (2D) and the biases (1D)
             if check_point_version == 0:
                 # 3, np, hn -> np, 3, hn
-                for key in checkpoint['state_dict']:
-                    if key.find('query_key_value') >= 0:
-                        weight = checkpoint['state_dict'][key]
-                        if len(weight.size()) == 2:
-                            # weight
-                            weight = weight.view(3, np, -1, weight.size()[-1])
-                            weight = weight.transpose(0, 1).contiguous()
-                            checkpoint['state_dict'][key] = weight.view(-1, weight.size()[-1])
-                        else:
-                            # biase
-                            weight = weight.view(3, np, -1)
-                            weight = weight.transpose(0, 1).contiguous()
-                            checkpoint['state_dict'][key] = weight.view(-1)
+                for key in qkv_keys:
+                    checkpoint['state_dict'][key] = einops.rearrange(
+                        checkpoint['state_dict'][key], '(three np hn) ... -> (np three hn) ...', three=3, np=np
+                    )
             elif check_point_version == 1:
                 # np, hn, 3 -> np, 3, hn
-                for key in checkpoint['state_dict']:
-                    if key.find('query_key_value') >= 0:
-                        weight = checkpoint['state_dict'][key]
-                        if len(weight.size()) == 2:
-                            # weight
-                            weight = weight.view(np, -1, 3, weight.size()[-1])
-                            weight = weight.transpose(1, 2).contiguous()
-                            checkpoint['state_dict'][key] = weight
-                        else:
-                            # biase
-                            weight = weight.view(np, -1, 3)
-                            weight = weight.transpose(1, 2).contiguous()
-                            checkpoint['state_dict'][key] = weight
+                for key in qkv_keys:
+                    checkpoint['state_dict'][key] = einops.rearrange(
+                        checkpoint['state_dict'][key], '(np hn three) ... -> (np three hn) ...', three=3, np=np
+                    )
 
         # for past checkpoint need to add the new key
         if cls.CHECKPOINT_HYPER_PARAMS_KEY not in checkpoint:
@@ -348,6 +478,10 @@ def load_from_checkpoint(
         steps = None
         if 'iteration' in old_checkpoint:
             steps = old_checkpoint['iteration']
+        # everything that is still needed has been moved to the new checkpoint,
+        # release the rest before the caller serializes it
+        del old_checkpoint
+        gc.collect()
     finally:
         cls._set_model_restore_state(is_being_restored=False)
     logging.warning(f"the checkpoint version is {check_point_version}")
@@ -376,6 +510,75 @@ def megatron_lm_inject_model_parallel_rank(filepath):
         return filepath
 
 
+def offload_to_pinned_memory(model: torch.nn.Module):
+    """
+    Moves any CUDA parameters and buffers of the model into page-locked host memory before it is serialized.
+    All device to host copies are issued asynchronously on a side stream and synchronized once at the end.
+    """
+    cuda_tensors = [tensor for tensor in itertools.chain(model.parameters(), model.buffers()) if tensor.is_cuda]
+    if not cuda_tensors:
+        return
+
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    host_tensors = []
+    with torch.cuda.stream(stream):
+        for tensor in cuda_tensors:
+            host_tensor = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=True)
+            host_tensor.copy_(tensor, non_blocking=True)
+            host_tensors.append(host_tensor)
+    stream.synchronize()
+
+    for tensor, host_tensor in zip(cuda_tensors, host_tensors):
+        tensor.data = host_tensor
+
+
+def save_checkpoint(checkpoint: dict, filepath: str):
+    """
+    Streams the checkpoint into the file through a large write buffer, so that the many small writes issued while
+    pickling are coalesced into few large ones, without holding a second serialized copy of the checkpoint in memory.
+    """
+    filepath = pathlib.Path(filepath)
+    filepath.parent.mkdir(parents=True, exist_ok=True)
+    with open(filepath, 'wb', buffering=64 * 1024 * 1024) as f:
+        torch.save(checkpoint, f)
+
+
+def save_distributed_checkpoint(checkpoint: dict, dirpath: str, thread_count: int = 8):
+    """
+    Saves the checkpoint in torch.distributed.checkpoint format. Every writer thread serializes into its own file,
+    which overlaps pickling with disk writes across threads.
+    """
+    storage_writer = dcp.FileSystemWriter(dirpath, thread_count=thread_count, per_thread_copy_ahead=10_000_000)
+    # every model parallel rank writes its own shard into its own directory, so no cross-rank planning is needed
+    multi_rank = torch.distributed.is_initialized() and torch.distributed.get_world_size() > 1
+    if hasattr(dcp, 'save') and (not multi_rank or 'no_dist' in inspect.signature(dcp.save).parameters):
+        # without other ranks, dcp.save doesn't synchronize anything
+        dcp.save(checkpoint, storage_writer=storage_writer, **({'no_dist': True} if multi_rank else {}))
+    else:
+        # torch<2.2 has no dcp.save, and older versions of it always plan across ranks
+        dcp.save_state_dict(state_dict=checkpoint, storage_writer=storage_writer, no_dist=True)
+
+
+def copy_for_background_save(checkpoint: dict) -> dict:
+    """
+    Copies what building the model for the .nemo file mutates while the checkpoint is being saved in the background.
+    The checkpoint and its state dict are copied shallowly, the hyper parameters deeply, since the model constructor
+    updates their cfg in place.
+    """
+    return dict(
+        checkpoint,
+        state_dict=dict(checkpoint['state_dict']),
+        hyper_parameters=copy.deepcopy(checkpoint['hyper_parameters']),
+    )
+
+
+def barrier_if_distributed():
+    # single process conversions have no other rank to wait for
+    if torch.distributed.is_initialized() and torch.distributed.get_world_size() > 1:
+        torch.distributed.barrier()
+
+
 def convert(local_rank, rank, world_size, args):
 
     app_state = AppState()
@@ -399,7 +602,11 @@ def convert(local_rank, rank, world_size, args):
     num_nodes = world_size // args.gpus_per_node
     assert world_size % args.gpus_per_node == 0, "world_size must be divisible by gpus_per_node"
 
-    trainer = Trainer(devices=args.gpus_per_node, accelerator='gpu', num_nodes=num_nodes)
+    # the trainer is only needed to instantiate the model for the .nemo file,
+    # the .ckpt conversion itself runs on CPU and is written out with torch.save
+    trainer = None
+    if args.nemo_file_path:
+        trainer = Trainer(devices=args.gpus_per_node, accelerator='gpu', num_nodes=num_nodes)
     checkpoint_path = megatron_lm_inject_model_parallel_rank(
         os.path.join(args.checkpoint_folder, args.checkpoint_name)
     )
@@ -419,6 +626,7 @@ def convert(local_rank, rank, world_size, args):
             trainer=trainer,
             translator=name_translate,
             strict=False,
+            direct_io=args.use_direct_io,
         )
     elif args.model_type == 'bert':
         # this dictionary is used to rename the model parameters
@@ -434,45 +642,74 @@ def convert(local_rank, rank, world_size, args):
             trainer=trainer,
             translator=name_translate,
             strict=False,
+            direct_io=args.use_direct_io,
         )
     else:
         raise NotImplemented("{} is not supported".format(args.model_type))
 
-    if torch.distributed.is_initialized():
-        torch.distributed.barrier()
+    barrier_if_distributed()
 
-    if args.output_ckpt_file_path:
-        filepath = args.output_ckpt_file_path
-        base_dir = pathlib.Path(filepath).parent
-        filename_str = pathlib.Path(filepath).name
-        suffix = '.ckpt'
-        content = {}
-        if consumed is not None:
-            content['consumed'] = consumed
-        else:
-            content['consumed'] = 0
-        if steps is not None:
-            content['steps'] = steps
-        else:
-            content['steps'] = 0
-        filename = filename_str.format(**content) + suffix
-        checkpoint_path_output = inject_model_parallel_rank(os.path.join(base_dir, filename))
-        trainer.training_type_plugin.checkpoint_io.save_checkpoint(checkpoint, checkpoint_path_output)
-        logging.info(f'NeMo model checkpoint files saved to: {args.output_ckpt_file_path}')
+    # outputs are written by a background thread so that building the model for the .nemo file
+    # overlaps with writing the .ckpt file; all writes are waited for, even if building the model fails
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending_saves = []
 
-    if args.nemo_file_path:
-        if args.model_type == 'gpt':
-            model = load_model(MegatronGPTModel, checkpoint, strict=False, trainer=trainer)
-        elif args.model_type == 'bert':
-            model = load_model(MegatronBertModel, checkpoint, strict=False, trainer=trainer)
-        else:
-            raise NotImplemented("{} is not supported".format(args.model_type))
+        if args.output_ckpt_file_path and os.path.isdir(args.output_ckpt_file_path):
+            checkpoint_path_output = inject_model_parallel_rank(
+                os.path.join(args.output_ckpt_file_path, 'model_weights')
+            )
+            pathlib.Path(checkpoint_path_output).mkdir(parents=True, exist_ok=True)
+            checkpoint_to_save = copy_for_background_save(checkpoint)
+            pending_saves.append(
+                (
+                    executor.submit(save_distributed_checkpoint, checkpoint_to_save, checkpoint_path_output),
+                    f'NeMo distributed checkpoint saved to: {checkpoint_path_output}',
+                )
+            )
+        elif args.output_ckpt_file_path:
+            filepath = args.output_ckpt_file_path
+            base_dir = pathlib.Path(filepath).parent
+            filename_str = pathlib.Path(filepath).name
+            suffix = '.ckpt'
+            content = {}
+            if consumed is not None:
+                content['consumed'] = consumed
+            else:
+                content['consumed'] = 0
+            if steps is not None:
+                content['steps'] = steps
+            else:
+                content['steps'] = 0
+            filename = filename_str.format(**content) + suffix
+            checkpoint_path_output = inject_model_parallel_rank(os.path.join(base_dir, filename))
+            # load_model below must not mutate the checkpoint while it is being serialized
+            checkpoint_to_save = copy_for_background_save(checkpoint)
+            pending_saves.append(
+                (
+                    executor.submit(save_checkpoint, checkpoint_to_save, checkpoint_path_output),
+                    f'NeMo model checkpoint files saved to: {args.output_ckpt_file_path}',
+                )
+            )
+
+        if args.nemo_file_path:
+            if args.model_type == 'gpt':
+                model = load_model(MegatronGPTModel, checkpoint, strict=False, trainer=trainer)
+            elif args.model_type == 'bert':
+                model = load_model(MegatronBertModel, checkpoint, strict=False, trainer=trainer)
+            else:
+                raise NotImplemented("{} is not supported".format(args.model_type))
+
+            # verify tensor parallel rank id and pipeline parallel rank id matches
+            assert app_state.data_parallel_size == 1
+            model._save_restore_connector = NLPSaveRestoreConnector()
+            offload_to_pinned_memory(model)
+            pending_saves.append(
+                (executor.submit(model.save_to, args.nemo_file_path), f'NeMo model saved to: {args.nemo_file_path}')
+            )
 
-        # verify tensor parallel rank id and pipeline parallel rank id matches
-        assert app_state.data_parallel_size == 1
-        model._save_restore_connector = NLPSaveRestoreConnector()
-        model.save_to(args.nemo_file_path)
-        logging.info(f'NeMo model saved to: {args.nemo_file_path}')
+        for future, message in pending_saves:
+            future.result()
+            logging.info(message)
 
 
 if __name__ == '__main__':
@@ -489,6 +726,6 @@ if __name__ == '__main__':
     # make sure the world size is divisible by tensor model parallel_size
     assert world_size % args.tensor_model_parallel_size == 0
 
-    torch.distributed.barrier()
+    barrier_if_distributed()
     convert(local_rank, rank, world_size, args)
-    torch.distributed.barrier()
+    barrier_if_distributed()
@@ -49,42 +49,457 @@ Re-rank beam candidates using cached score file only
 """
 
 
+import csv
+import functools
+import gc
+import itertools
+import types
 from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
+import pandas as pd
 import torch
+import torch.nn.functional as F
 
 import nemo.collections.nlp as nemo_nlp
+from nemo.collections.nlp.modules.common.transformer.transformer_modules import MultiHeadAttention
 from nemo.utils import logging
 
 
+class CUDAGraphForward:
+    """
+    Replays a function of padded batches from CUDA graphs, one per bucketed batch size and sequence lengths.
+    The inputs alternate between token ids and masks, every pair is zero padded up to the next length bucket and the
+    batch up to the next batch size bucket. The outputs, one value per sequence, are cut back to the batch size.
+    All graphs share one memory pool, so that only their small outputs stay allocated between replays.
+    Inputs larger than the largest buckets run eagerly.
+    """
+
+    def __init__(self, fn, max_batch_size, buckets=(32, 64, 128, 256)):
+        self.fn = fn
+        # powers of two up to the largest batch size
+        self.batch_buckets = sorted({min(1 << i, max_batch_size) for i in range(max_batch_size.bit_length() + 1)})
+        self.buckets = buckets
+        self.graphs = {}
+        self.pool = torch.cuda.graph_pool_handle()
+
+    def __call__(self, *inputs):
+        batch_size = next((bucket for bucket in self.batch_buckets if bucket >= inputs[0].size(0)), None)
+        lengths = [
+            next((bucket for bucket in self.buckets if bucket >= tensor.size(1)), None) for tensor in inputs[::2]
+        ]
+        if batch_size is None or None in lengths:
+            return self.fn(*inputs)
+        # every mask is padded to the same bucket length as the token ids before it
+        padded_inputs = [
+            F.pad(tensor, (0, lengths[i // 2] - tensor.size(1), 0, batch_size - tensor.size(0)))
+            for i, tensor in enumerate(inputs)
+        ]
+
+        key = (batch_size, *lengths)
+        if key not in self.graphs:
+            self.graphs[key] = self.capture(padded_inputs)
+        graph, static_inputs, static_outputs = self.graphs[key]
+        for static_input, padded_input in zip(static_inputs, padded_inputs):
+            static_input.copy_(padded_input)
+        graph.replay()
+        return tuple(static_output[: inputs[0].size(0)] for static_output in static_outputs)
+
+    def capture(self, static_inputs):
+        # warm up on a side stream before capturing, as required by CUDA graph capture
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                self.fn(*static_inputs)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        # the tokenization thread may allocate pinned host buffers while a graph is captured
+        with torch.cuda.graph(graph, pool=self.pool, capture_error_mode='thread_local'):
+            static_outputs = self.fn(*static_inputs)
+        return graph, static_inputs, static_outputs
+
+
+def compile_model(model, mode):
+    """
+    Compiles the forward pass of `model` in place with `torch.compile` and returns it.
+    `torch.compile` compiles lazily, on the first call with each new input shape. If compiling fails then, the eager
+    forward pass is restored and runs instead. The model is left to run eagerly if this version of PyTorch can't
+    compile at all.
+    """
+    if not hasattr(torch, 'compile'):
+        logging.warning("torch.compile is not available in this version of PyTorch, running the model eagerly.")
+        return model
+    from torch._dynamo.exc import TorchDynamoException
+
+    eager_forward = model.forward
+    try:
+        compiled_forward = torch.compile(eager_forward, mode=mode)
+    except RuntimeError as e:
+        logging.warning(f"Could not compile {type(model).__name__}, running it eagerly: {e}")
+        return model
+
+    def forward(*args, **kwargs):
+        try:
+            return compiled_forward(*args, **kwargs)
+        except TorchDynamoException as e:
+            logging.warning(f"Could not compile {type(model).__name__}, running it eagerly: {e}")
+            model.forward = eager_forward
+            return eager_forward(*args, **kwargs)
+
+    # checking the input ids syncs with the host and breaks the compiled graph
+    if hasattr(model, 'validate_input_ids'):
+        model.validate_input_ids = False
+    model.forward = forward
+    return model
+
+
+def sdpa_attention_forward(self, queries, keys, values, attention_mask):
+    """
+    `MultiHeadAttention.forward` computed with `torch.nn.functional.scaled_dot_product_attention`, which dispatches to
+    fused attention kernels. Its default scale of 1 / sqrt(d) is the same as pre-dividing query and key by sqrt(sqrt(d)).
+    """
+    query = self.transpose_for_scores(self.query_net(queries))
+    key = self.transpose_for_scores(self.key_net(keys))
+    value = self.transpose_for_scores(self.value_net(values))
+    if attention_mask is not None:
+        attention_mask = attention_mask.to(query.dtype)
+
+    context = F.scaled_dot_product_attention(
+        query, key, value, attn_mask=attention_mask, dropout_p=self.attn_dropout.p if self.training else 0.0
+    )
+    context = context.permute(0, 2, 1, 3).contiguous()
+    context = context.view(*context.size()[:-2], self.hidden_size)
+
+    # output projection
+    output_states = self.out_projection(context)
+    output_states = self.layer_dropout(output_states)
+    return output_states
+
+
+def use_sdpa_attention(model):
+    """
+    Replaces the forward pass of all `MultiHeadAttention` layers of `model` with `sdpa_attention_forward`.
+    The model is left unchanged if this version of PyTorch has no `scaled_dot_product_attention`.
+    """
+    if not hasattr(F, 'scaled_dot_product_attention'):
+        logging.warning(
+            "scaled_dot_product_attention is not available in this version of PyTorch, using NeMo attention."
+        )
+        return model
+    for module in model.modules():
+        if isinstance(module, MultiHeadAttention):
+            module.forward = types.MethodType(sdpa_attention_forward, module)
+    return model
+
+
+def quantize_model(model):
+    """
+    Quantizes the weights of all linear layers of `model` to INT8 in place, activations are quantized dynamically.
+    Dynamically quantized models only run on CPU.
+    """
+    torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    return model
+
+
+def release_training_state(model):
+    """
+    Drops the data loaders, optimizer and scheduler that a model restored from a .nemo file may hold, none of which
+    are needed for inference.
+    """
+    for name in ('_train_dl', '_validation_dl', '_test_dl', '_optimizer', '_scheduler'):
+        if getattr(model, name, None) is not None:
+            setattr(model, name, None)
+    return model
+
+
 def score_fusion(args, forward_scores, rev_scores, lm_scores, src_lens, tgt_lens):
     """
     Fuse forward, reverse and language model scores.
+    Scores and lengths are fused elementwise as tensors of any shape, e.g. (num_sentences, beam_size), on the device
+    of `rev_scores`. The index of the best candidate of a beam is `argmax` of the result.
     """
-    fused_scores = []
-    for forward_score, rev_score, lm_score, src_len, tgt_len in zip(
-        forward_scores, rev_scores, lm_scores, src_lens, tgt_lens
-    ):
-        score = 0
+    device = rev_scores.device if torch.is_tensor(rev_scores) else None
+    forward_scores, rev_scores, lm_scores, src_lens, tgt_lens = (
+        torch.as_tensor(values, dtype=torch.float64, device=device)
+        for values in (forward_scores, rev_scores, lm_scores, src_lens, tgt_lens)
+    )
 
-        forward_score = forward_score / tgt_len if args.length_normalize_scores else forward_score
-        score += args.forward_model_coef * forward_score
+    if args.length_normalize_scores:
+        forward_scores = forward_scores / tgt_lens
+        rev_scores = rev_scores / src_lens
+        lm_scores = lm_scores / tgt_lens
 
-        rev_score = rev_score / src_len if args.length_normalize_scores else rev_score
-        score += args.reverse_model_coef * rev_score
+    fused_scores = (
+        args.forward_model_coef * forward_scores
+        + args.reverse_model_coef * rev_scores
+        + args.target_lm_coef * lm_scores
+    )
 
-        lm_score = lm_score / tgt_len if args.length_normalize_scores else lm_score
-        score += args.target_lm_coef * lm_score
+    if args.len_pen is not None:
+        fused_scores /= ((5 + tgt_lens) / 6) ** args.len_pen
 
-        if args.len_pen is not None:
-            score = score / (((5 + tgt_len) / 6) ** args.len_pen)
+    return fused_scores
 
-        fused_scores.append(score)
 
-    return fused_scores
+def tokenize(model, texts, target=False):
+    """
+    Tokenizes `texts` like `MTEncDecModel.prepare_inference_batch`, but without padding them into a batch.
+    """
+    processor = model.target_processor if target else model.source_processor
+    tokenizer = model.decoder_tokenizer if target else model.encoder_tokenizer
+    ids = []
+    for text in texts:
+        text = text.rstrip("\n")
+        if processor is not None:
+            text = processor.tokenize(processor.normalize(text))
+        ids.append([tokenizer.bos_id] + tokenizer.text_to_ids(text) + [tokenizer.eos_id])
+    return ids
+
+
+class HostBuffers:
+    """
+    Flat token id buffers in (pinned) host memory that macro batches are padded into, so that no new host tensors are
+    allocated per batch. Buffers are handed out in rotation and grow to the largest macro batch seen. A buffer is only
+    reused `num_buffers` macro batches later, which must be after the macro batch using it has been scored.
+    """
+
+    def __init__(self, num_buffers, pin_memory=False):
+        self.pin_memory = pin_memory
+        self.buffers = [torch.empty(0, dtype=torch.long) for _ in range(num_buffers)]
+        self.next = 0
 
+    def get(self, numel):
+        i = self.next
+        self.next = (i + 1) % len(self.buffers)
+        if self.buffers[i].numel() < numel:
+            self.buffers[i] = torch.empty(numel, dtype=torch.long, pin_memory=self.pin_memory)
+        return self.buffers[i]
 
+
+def pad_batch(ids, pad_id, out):
+    """
+    Pads token ids to the longest sequence, writing them to the start of the flat host buffer `out`.
+    Returns the padded ids as a contiguous view of `out`.
+    """
+    max_len = max(len(seq) for seq in ids)
+    batch = out[: len(ids) * max_len].view(len(ids), max_len).fill_(pad_id)
+    # rows are written through a numpy view of the buffer, without allocating a tensor per sequence
+    array = batch.numpy()
+    for i, seq in enumerate(ids):
+        array[i, : len(seq)] = seq
+    return batch
+
+
+def copy_batches(batches, device):
+    """
+    Yields the padded host batches copied to `device`.
+    On GPU all copies are issued up front on a side stream, so that they overlap with the forward passes of the
+    batches before them, and the current stream only waits for the copy of the batch it's about to use.
+    """
+    if device.type != 'cuda':
+        for tensors in batches:
+            yield tuple(tensor.to(device) for tensor in tensors)
+        return
+
+    copy_stream = torch.cuda.Stream()
+    copy_stream.wait_stream(torch.cuda.current_stream())
+    copies = []
+    with torch.cuda.stream(copy_stream):
+        for tensors in batches:
+            tensors = tuple(tensor.to(device, non_blocking=True) for tensor in tensors)
+            event = torch.cuda.Event()
+            event.record()
+            copies.append((event, tensors))
+    for event, tensors in copies:
+        torch.cuda.current_stream().wait_event(event)
+        for tensor in tensors:
+            # memory allocated on the copy stream must not be reused before the current stream is done with it
+            tensor.record_stream(torch.cuda.current_stream())
+        yield tensors
+
+
+def sequence_log_likelihood(log_probs, labels, mask):
+    """
+    Sums the log-probabilities of `labels` over the unmasked positions of each sequence.
+    Only the log-probabilities of the labels are gathered from the (batch, time, vocabulary) output, instead of
+    computing a loss over all of it.
+    """
+    # the sum is always computed in FP32 for numerical stability, even if the forward pass ran in FP16
+    label_log_probs = log_probs.gather(-1, labels.unsqueeze(-1)).squeeze(-1).float()
+    return (label_log_probs * mask).sum(1)
+
+
+def score_batch(reverse_models, lm_model, src, src_mask, tgt, tgt_mask):
+    """
+    Returns reverse model ensemble and LM log-likelihoods of a padded batch of reverse direction candidates,
+    on the device of the models.
+    """
+    # Ensemble of reverse model scores, summed in place and averaged once.
+    reverse_scores = None
+    for model in reverse_models:
+        nmt_log_probs = model(src, src_mask, tgt[:, :-1], tgt_mask[:, :-1])
+        nmt_ll = sequence_log_likelihood(nmt_log_probs, tgt[:, 1:], tgt_mask[:, 1:])
+        reverse_scores = nmt_ll if reverse_scores is None else reverse_scores.add_(nmt_ll)
+    reverse_scores /= len(reverse_models)
+
+    # LM scores.
+    if lm_model is not None:
+        # Compute LM score for the src of the reverse model.
+        lm_log_probs = lm_model(src[:, :-1], src_mask[:, :-1])
+        lm_scores = sequence_log_likelihood(lm_log_probs, src[:, 1:], src_mask[:, 1:])
+    else:
+        lm_scores = torch.zeros_like(reverse_scores)
+    return reverse_scores, lm_scores
+
+
+def grouper(iterable, n):
+    """
+    Yields lists of `n` consecutive items of `iterable`, the last list may be shorter.
+    """
+    iterator = iter(iterable)
+    return iter(lambda: list(itertools.islice(iterator, n)), [])
+
+
+def read_macro_batches(args, src_f):
+    """
+    Yields the tab separated fields of the beam candidates of `args.macro_batch_size` sentences at a time.
+    Candidates of a trailing incomplete beam are dropped.
+    """
+    for lines in grouper(src_f, args.beam_size * args.macro_batch_size):
+        if len(lines) % args.beam_size != 0:
+            logging.warning(
+                f"Dropping the last {len(lines) % args.beam_size} lines of an incomplete beam, --beam_size may be set incorrectly."
+            )
+            lines = lines[: len(lines) - len(lines) % args.beam_size]
+        if lines:
+            yield [line.strip().split('\t') for line in lines]
+
+
+def prefetch(executor, fn, iterable, depth=2):
+    """
+    Yields `fn(item)` for every item of `iterable` in order, computing up to `depth` results ahead in `executor`.
+    """
+    futures = deque()
+    for item in iterable:
+        futures.append(executor.submit(fn, item))
+        if len(futures) > depth:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+def prepare_candidates(args, model, buffers, src_text):
+    """
+    Tokenizes the beam candidates of several sentences and pads them into length sorted batches in one of the
+    `HostBuffers`. Runs ahead of `rerank_candidates` in a background thread.
+    """
+    # Source and target sequences are flipped for the reverse direction model.
+    src_texts = [item[1] for item in src_text]
+    tgt_texts = [item[0] for item in src_text]
+    forward_scores = np.array([float(item[2]) for item in src_text], dtype=np.float64)
+
+    # Candidates whose forward score is more than --rerank_gap below the best of their beam are not scored at all.
+    if args.rerank_gap is not None:
+        beam_forward_scores = forward_scores.reshape(-1, args.beam_size)
+        keep = (beam_forward_scores >= beam_forward_scores.max(1, keepdims=True) - args.rerank_gap).ravel()
+    else:
+        keep = np.ones(len(forward_scores), dtype=bool)
+
+    # Beams often contain duplicate candidates, only unique pairs of source and target are tokenized and scored.
+    # `inverse` maps every candidate to the index of its unique pair, and dropped candidates to the index after them.
+    unique_pairs = {}
+    inverse = np.array(
+        [
+            unique_pairs.setdefault(pair, len(unique_pairs)) if kept else -1
+            for pair, kept in zip(zip(src_texts, tgt_texts), keep)
+        ]
+    )
+    inverse[~keep] = len(unique_pairs)
+    src_ids = tokenize(model, [pair[0] for pair in unique_pairs])
+    tgt_ids = tokenize(model, [pair[1] for pair in unique_pairs], target=True)
+    src_lens = np.array([len(ids) for ids in src_ids], dtype=np.float64)
+    tgt_lens = np.array([len(ids) for ids in tgt_ids], dtype=np.float64)
+
+    # Candidates are scored in order of length, so that each forward batch is padded to a similar length,
+    # and the scores are scattered back to the original order.
+    order = np.argsort(np.maximum(src_lens, tgt_lens), kind='stable')
+    chunks = [order[start : start + args.batch_size] for start in range(0, len(order), args.batch_size)]
+
+    # Indices, padded token ids and the inverse map of the whole macro batch are laid out one after another in a
+    # single host buffer.
+    numel = len(order) + len(inverse)
+    for indices in chunks:
+        numel += len(indices) * int(src_lens[indices].max() + tgt_lens[indices].max())
+    buffer = buffers.get(numel)
+    offset = 0
+    batches = []
+    for indices in chunks:
+        batch = [buffer[offset : offset + len(indices)].copy_(torch.from_numpy(indices))]
+        offset += len(indices)
+        for ids, pad_id in (
+            ([src_ids[i] for i in indices], model.encoder_tokenizer.pad_id),
+            ([tgt_ids[i] for i in indices], model.decoder_tokenizer.pad_id),
+        ):
+            batch.append(pad_batch(ids, pad_id, buffer[offset:]))
+            offset += batch[-1].numel()
+        batches.append(tuple(batch))
+    # dropped candidates aren't tokenized, their lengths are reported as 0
+    src_lens, tgt_lens = np.append(src_lens, 0)[inverse], np.append(tgt_lens, 0)[inverse]
+    inverse = buffer[offset : offset + len(inverse)].copy_(torch.from_numpy(inverse))
+    return src_texts, tgt_texts, forward_scores, src_lens, tgt_lens, inverse, batches
+
+
+def rerank_candidates(args, model, score_fn, candidates):
+    """
+    Scores the beam candidates of several sentences prepared by `prepare_candidates` with `score_fn`, `score_batch`
+    of the reverse models and LM, and re-ranks each beam. `model` is the first reverse model.
+    Returns the best candidate of every sentence and, for every candidate, the forward, reverse and LM scores and the
+    source and target lengths in the reverse direction as tensors on the device of the models.
+    """
+    src_texts, _, forward_scores, src_lens, tgt_lens, inverse, batches = candidates
+    num_unique = sum(len(batch[0]) for batch in batches)
+    # the slot after the unique candidates holds the scores of candidates dropped by --rerank_gap
+    reverse_scores = torch.full((num_unique + 1,), float('-inf'), device=model.device)
+    lm_scores = torch.full((num_unique + 1,), float('-inf'), device=model.device)
+    for indices, src, tgt in copy_batches(batches, model.device):
+        src_mask = (src != model.encoder_tokenizer.pad_id).float()
+        tgt_mask = (tgt != model.decoder_tokenizer.pad_id).float()
+        with torch.autocast(
+            device_type='cuda',
+            dtype=torch.float16,
+            enabled=args.fp16 and model.device.type == 'cuda',
+            # weights cast outside of a graph capture can't be reused inside of it
+            cache_enabled=not args.cuda_graphs,
+        ):
+            reverse_scores[indices], lm_scores[indices] = score_fn(src, src_mask, tgt, tgt_mask)
+    # Scores of unique candidates are copied to all of their duplicates.
+    inverse = inverse.to(model.device, non_blocking=True)
+    reverse_scores, lm_scores = reverse_scores[inverse], lm_scores[inverse]
+
+    # Scores are fused on the device of the models, only the index of the best candidate of each beam is
+    # copied back to the host.
+    forward_scores, src_lens, tgt_lens = (
+        torch.from_numpy(values).to(model.device) for values in (forward_scores, src_lens, tgt_lens)
+    )
+    num_sentences = len(src_texts) // args.beam_size
+    fused_scores = score_fusion(
+        args,
+        *(
+            scores.view(num_sentences, args.beam_size)
+            for scores in (forward_scores, reverse_scores, lm_scores, src_lens, tgt_lens)
+        ),
+    )
+    # dropped candidates can never win, even if some of the coefficients are 0
+    fused_scores.masked_fill_(inverse.view(num_sentences, args.beam_size) == num_unique, float('-inf'))
+    best_texts = [src_texts[i * args.beam_size + best] for i, best in enumerate(fused_scores.argmax(1).tolist())]
+    return best_texts, forward_scores, reverse_scores, lm_scores, src_lens, tgt_lens
+
+
+@torch.inference_mode()
 def main():
     parser = ArgumentParser()
     parser.add_argument(
@@ -131,6 +546,51 @@ def main():
         default=4,
         help="Beam size with which forward model translations were generated. IMPORTANT: mismatch can lead to wrong results and an incorrect number of generated translations.",
     )
+    parser.add_argument(
+        "--macro_batch_size",
+        type=int,
+        default=64,
+        help="Number of sentences whose beam candidates are read, sorted by length and scored together.",
+    )
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=256,
+        help="Maximum number of beam candidates in one forward pass of each model.",
+    )
+    parser.add_argument(
+        "--fp16",
+        action="store_true",
+        help="Run the reverse model and LM forward passes in FP16 autocast on GPU. Scores are still accumulated in FP32.",
+    )
+    parser.add_argument(
+        "--cuda_graphs",
+        action="store_true",
+        help="Capture the reverse model and LM scoring of a batch as CUDA graphs, one per bucketed batch size and sequence lengths, and replay them.",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Compile the reverse model and LM forward passes with torch.compile. Without --cuda_graphs they are compiled in 'reduce-overhead' mode, which also replays them from CUDA graphs.",
+    )
+    parser.add_argument(
+        "--rerank_gap",
+        type=float,
+        default=None,
+        help="If set, candidates whose forward score is more than this many log-probability units below the best forward score of their beam are not scored by the reverse models and LM and are never picked. Their reverse and LM scores are written as -inf. Trades quality for speed, e.g. 3.0.",
+    )
+    parser.add_argument(
+        "--use_sdpa",
+        action="store_true",
+        help="Compute the attention of the reverse models and LM with torch.nn.functional.scaled_dot_product_attention, which uses fused attention kernels where available.",
+    )
+    parser.add_argument(
+        "--quantize",
+        type=str,
+        default="none",
+        choices=["none", "int8_dynamic"],
+        help="Quantize the linear layers of the reverse models and LM. int8_dynamic uses INT8 weights with dynamically quantized activations and keeps the models on CPU, which may cost some BLEU.",
+    )
     parser.add_argument(
         "--target_lang", type=str, default=None, help="Target language identifier ex: en,de,fr,es etc."
     )
@@ -153,7 +613,6 @@ def main():
     )
 
     args = parser.parse_args()
-    torch.set_grad_enabled(False)
 
     if args.cached_score_file is None:
         reverse_models = []
@@ -161,12 +620,12 @@ def main():
             if not model_path.endswith('.nemo'):
                 raise NotImplementedError(f"Only support .nemo files, but got: {model_path}")
             model = nemo_nlp.models.machine_translation.MTEncDecModel.restore_from(restore_path=model_path).eval()
-            model.eval_loss_fn.reduction = 'none'
-            reverse_models.append(model)
+            reverse_models.append(release_training_state(model))
 
         lm_model = nemo_nlp.models.language_modeling.TransformerLMModel.restore_from(
             restore_path=args.language_model
         ).eval()
+        release_training_state(lm_model)
 
     if args.srctext is not None and args.cached_score_file is not None:
         raise ValueError("Only one of --srctext or --cached_score_file must be provided.")
@@ -180,17 +639,39 @@ def main():
         logging.info(f"Re-ranking from cached score file only: {args.cached_score_file}")
 
     if args.cached_score_file is None:
-        if torch.cuda.is_available():
+        if args.use_sdpa:
+            reverse_models = [use_sdpa_attention(model) for model in reverse_models]
+            lm_model = use_sdpa_attention(lm_model)
+        if args.quantize == 'int8_dynamic':
+            reverse_models = [quantize_model(model) for model in reverse_models]
+            lm_model = quantize_model(lm_model)
+        elif torch.cuda.is_available():
             reverse_models = [model.cuda() for model in reverse_models]
             lm_model = lm_model.cuda()
+            # leave as much memory as possible for the forward passes of large batches
+            gc.collect()
+            torch.cuda.empty_cache()
+            if args.compile:
+                # graphs captured by CUDAGraphForward are bucketed by length, compiled graphs are not
+                mode = 'default' if args.cuda_graphs else 'reduce-overhead'
+                reverse_models = [compile_model(model, mode) for model in reverse_models]
+                lm_model = compile_model(lm_model, mode)
+
+        score_fn = functools.partial(score_batch, reverse_models, lm_model)
+        if args.cuda_graphs and reverse_models[0].device.type == 'cuda':
+            # checking the input ids syncs with the host, which is not allowed while capturing a graph
+            for model in reverse_models + [lm_model]:
+                if hasattr(model, 'validate_input_ids'):
+                    model.validate_input_ids = False
+            score_fn = CUDAGraphForward(score_fn, args.batch_size)
 
-    src_text = []
     tgt_text = []
     all_reverse_scores = []
     all_lm_scores = []
     all_forward_scores = []
     all_src_lens = []
     all_tgt_lens = []
+    all_text_columns = []
 
     # Chceck args if re-ranking from cached score file.
     if args.cached_score_file is not None:
@@ -207,113 +688,84 @@ def main():
 
     if args.srctext is not None:
         # Compute reverse scores and LM scores from the provided models since cached scores file is not provided.
-        with open(args.srctext, 'r') as src_f:
+        # Reading and tokenizing the next macro batches runs in a background thread while the current one is scored.
+        with open(args.srctext, 'r') as src_f, ThreadPoolExecutor(max_workers=1) as executor:
             count = 0
-            for line in src_f:
-                src_text.append(line.strip().split('\t'))
-                if len(src_text) == args.beam_size:
-                    # Source and target sequences are flipped for the reverse direction model.
-                    src_texts = [item[1] for item in src_text]
-                    tgt_texts = [item[0] for item in src_text]
-                    src, src_mask = reverse_models[0].prepare_inference_batch(src_texts)
-                    tgt, tgt_mask = reverse_models[0].prepare_inference_batch(tgt_texts, target=True)
-                    src_lens = src_mask.sum(1).data.cpu().tolist()
-                    tgt_lens = tgt_mask.sum(1).data.cpu().tolist()
-                    forward_scores = [float(item[2]) for item in src_text]
-
-                    # Ensemble of reverse model scores.
-                    nmt_lls = []
-                    for model in reverse_models:
-                        nmt_log_probs = model(src, src_mask, tgt[:, :-1], tgt_mask[:, :-1])
-                        nmt_nll = model.eval_loss_fn(log_probs=nmt_log_probs, labels=tgt[:, 1:])
-                        nmt_ll = nmt_nll.view(nmt_log_probs.size(0), nmt_log_probs.size(1)).sum(1) * -1.0
-                        nmt_ll = nmt_ll.data.cpu().numpy().tolist()
-                        nmt_lls.append(nmt_ll)
-                    reverse_scores = np.stack(nmt_lls).mean(0)
-
-                    # LM scores.
-                    if lm_model is not None:
-                        # Compute LM score for the src of the reverse model.
-                        lm_log_probs = lm_model(src[:, :-1], src_mask[:, :-1])
-                        lm_nll = model.eval_loss_fn(log_probs=lm_log_probs, labels=src[:, 1:])
-                        lm_ll = lm_nll.view(lm_log_probs.size(0), lm_log_probs.size(1)).sum(1) * -1.0
-                        lm_ll = lm_ll.data.cpu().numpy().tolist()
-                    else:
-                        lm_ll = None
-                    lm_scores = lm_ll
-
-                    all_reverse_scores.extend(reverse_scores)
-                    all_lm_scores.extend(lm_scores)
-                    all_forward_scores.extend(forward_scores)
+            # one buffer for each prefetched macro batch and one for the macro batch being scored
+            prefetch_depth = 2
+            buffers = HostBuffers(prefetch_depth + 1, pin_memory=reverse_models[0].device.type == 'cuda')
+            prepare = functools.partial(prepare_candidates, args, reverse_models[0], buffers)
+            for candidates in prefetch(executor, prepare, read_macro_batches(args, src_f), prefetch_depth):
+                best_texts, forward_scores, reverse_scores, lm_scores, src_lens, tgt_lens = rerank_candidates(
+                    args, reverse_models[0], score_fn, candidates
+                )
+                tgt_text.extend(best_texts)
 
+                if args.write_scores:
+                    # Source and target texts are swapped back to their columns in --srctext.
+                    src_texts, tgt_texts = candidates[:2]
+                    all_text_columns.extend(zip(tgt_texts, src_texts))
+
+                    # All scores of the macro batch are copied to the host at once.
                     # Swapping source and target here back again since this is what gets written to the file.
-                    all_src_lens.extend(tgt_lens)
-                    all_tgt_lens.extend(src_lens)
+                    scores = torch.stack(
+                        [forward_scores, reverse_scores.double(), lm_scores.double(), tgt_lens, src_lens]
+                    ).tolist()
+                    for all_scores, macro_batch_scores in zip(
+                        (all_forward_scores, all_reverse_scores, all_lm_scores, all_src_lens, all_tgt_lens), scores
+                    ):
+                        all_scores.extend(macro_batch_scores)
 
-                    fused_scores = score_fusion(args, forward_scores, reverse_scores, lm_scores, src_lens, tgt_lens)
-                    tgt_text.append(src_texts[np.argmax(fused_scores)])
-                    src_text = []
-                    count += 1
-                    print(f'Reranked {count} sentences')
+                count += len(best_texts)
+                print(f'Reranked {count} sentences')
 
     else:
         # Use reverse and LM scores from the cached scores file to re-rank.
-        with open(args.cached_score_file, 'r') as src_f:
-            count = 0
-            for line in src_f:
-                src_text.append(line.strip().split('\t'))
-                if len(src_text) == args.beam_size:
-                    if not all([len(item) == 7 for item in src_text]):
-                        raise IndexError(
-                            "All lines did not contain exactly 5 fields. Format - src_txt \t tgt_text \t forward_score \t reverse_score \t lm_score \t src_len \t tgt_len"
-                        )
-                    src_texts = [item[0] for item in src_text]
-                    tgt_texts = [item[1] for item in src_text]
-                    forward_scores = [float(item[2]) for item in src_text]
-                    reverse_scores = [float(item[3]) for item in src_text]
-                    lm_scores = [float(item[4]) for item in src_text]
-                    src_lens = [float(item[5]) for item in src_text]
-                    tgt_lens = [float(item[6]) for item in src_text]
-
-                    fused_scores = score_fusion(args, forward_scores, reverse_scores, lm_scores, src_lens, tgt_lens)
-                    tgt_text.append(tgt_texts[np.argmax(fused_scores)])
-                    src_text = []
-                    count += 1
-                    print(f'Reranked {count} sentences')
+        cached_scores = pd.read_csv(
+            args.cached_score_file,
+            sep='\t',
+            header=None,
+            quoting=csv.QUOTE_NONE,
+            keep_default_na=False,
+            dtype={0: str, 1: str},
+        )
+        if cached_scores.shape[1] != 7 or cached_scores.isnull().values.any():
+            raise IndexError(
+                "All lines did not contain exactly 7 fields. Format - src_txt \t tgt_text \t forward_score \t reverse_score \t lm_score \t src_len \t tgt_len"
+            )
+        num_sentences = len(cached_scores) // args.beam_size
+        if len(cached_scores) % args.beam_size != 0:
+            logging.warning(
+                f"Dropping the last {len(cached_scores) % args.beam_size} lines of an incomplete beam, --beam_size may be set incorrectly."
+            )
+        cached_scores = cached_scores.iloc[: num_sentences * args.beam_size]
+
+        forward_scores, reverse_scores, lm_scores, src_lens, tgt_lens = (
+            torch.from_numpy(cached_scores[column].to_numpy(dtype=np.float64)).view(num_sentences, args.beam_size)
+            for column in range(2, 7)
+        )
+        fused_scores = score_fusion(args, forward_scores, reverse_scores, lm_scores, src_lens, tgt_lens)
+        # candidates dropped by --rerank_gap were written with -inf scores, they can never win, even if some of the
+        # coefficients are 0 or scores are length normalized, which turns their fused scores into NaN
+        dropped = ~(torch.isfinite(reverse_scores) & torch.isfinite(lm_scores))
+        fused_scores.masked_fill_(dropped, float('-inf'))
+        tgt_texts = cached_scores[1].to_numpy().reshape(num_sentences, args.beam_size)
+        tgt_text = tgt_texts[np.arange(num_sentences), fused_scores.argmax(1).numpy()].tolist()
+        print(f'Reranked {num_sentences} sentences')
 
     with open(args.tgtout, 'w') as tgt_f:
-        for line in tgt_text:
-            tgt_f.write(line + "\n")
+        tgt_f.writelines(line + '\n' for line in tgt_text)
 
     # Write scores file
     if args.write_scores:
-        with open(args.tgtout + '.scores', 'w') as tgt_f, open(args.srctext, 'r') as src_f:
-            src_lines = []
-            for line in src_f:
-                src_lines.append(line.strip().split('\t'))
-            if not (len(all_reverse_scores) == len(all_lm_scores) == len(all_forward_scores) == len(src_lines)):
-                raise ValueError(
-                    f"Length of scores files do not match. {len(all_reverse_scores)} != {len(all_lm_scores)} != {len(all_forward_scores)} != {len(src_lines)}. This is most likely because --beam_size is set incorrectly. This needs to be set to the same value that was used to generate translations."
-                )
-            for f, r, lm, sl, tl, src in zip(
-                all_forward_scores, all_reverse_scores, all_lm_scores, all_src_lens, all_tgt_lens, src_lines
-            ):
-                tgt_f.write(
-                    src[0]
-                    + '\t'
-                    + src[1]
-                    + '\t'
-                    + str(f)
-                    + '\t'
-                    + str(r)
-                    + '\t'
-                    + str(lm)
-                    + '\t'
-                    + str(sl)
-                    + '\t'
-                    + str(tl)
-                    + '\n'
+        # Only candidates of complete beams were scored, incomplete ones were reported while reading --srctext.
+        with open(args.tgtout + '.scores', 'w') as tgt_f:
+            tgt_f.writelines(
+                '\t'.join((src, tgt, str(f), str(r), str(lm), str(sl), str(tl))) + '\n'
+                for f, r, lm, sl, tl, (src, tgt) in zip(
+                    all_forward_scores, all_reverse_scores, all_lm_scores, all_src_lens, all_tgt_lens, all_text_columns
                 )
+            )
 
 
 if __name__ == '__main__':